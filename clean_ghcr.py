@@ -1,21 +1,42 @@
+import asyncio
+import atexit
+import functools
 import json
+import logging
 import os
-import subprocess
+import sys
+import time
 import urllib.parse
 
-import requests
+import aiohttp
 import argparse
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 API_ENDPOINT = "https://api.github.com"
-PER_PAGE = 30  # max 100 defaults 30
-DOCKER_ENDPOINT = "ghcr.io/"
+PER_PAGE = 100  # max 100 defaults 30
+REGISTRY_ENDPOINT = "https://ghcr.io"
+MANIFEST_ACCEPT = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
 LOG_LEVEL = 0
+CONCURRENCY = 10  # keep below github secondary rate limit
+MAX_TRIES = 5
+BACKOFF = 0.5  # seconds, doubled on every retry of a server error
+ETAG_CACHE_PATH = os.path.expanduser("~/.cache/clean-ghcr/etags.json")
+ETAG_CACHE = {}  # url -> etag, body and links of the last 200 response
+ETAG_CACHE_USED = set()  # keys still valid in this run, the rest is dropped
 
+logger = logging.getLogger("ghcr")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
 
-def log(*args, level=0, **kwargs):
+
+def log(*args, level=0):
     if level <= LOG_LEVEL:
-        print(*args, **kwargs)
+        logger.info(" ".join(str(arg) for arg in args))
 
 
 def get_url(path):
@@ -24,70 +45,203 @@ def get_url(path):
     return f"{API_ENDPOINT}{path}"
 
 
-def get_base_headers():
-    return {
-        "Authorization": "Bearer {}".format(args.token),
-        "Accept": "application/vnd.github+json",
-    }
+def get_retry_delay(response, attempt):
+    if response.status in (403, 429):
+        if "retry-after" in response.headers:
+            return int(response.headers["retry-after"])
+        if response.headers.get("x-ratelimit-remaining") == "0":
+            reset = int(response.headers.get("x-ratelimit-reset", 0))
+            return max(reset - time.time(), 0) + 1
+        return None
+    if response.status >= 500:
+        return BACKOFF * 2**attempt
+    return None
+
+
+def retry(max_tries=MAX_TRIES):
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_tries):
+                response = await func(*args, **kwargs)
+                delay = get_retry_delay(response, attempt)
+                if delay is None or attempt == max_tries - 1:
+                    return response
+                log(f'{response.status} {response.url}, retry in {delay}s',
+                    level=0)
+                await asyncio.sleep(delay)
+
+        return wrapper
+
+    return decorator
 
 
-def del_req(path):
+# stands in for a 304 Not Modified with the body of the cached 200 response
+class CachedResponse:
+    status = 200
+    ok = True
+    headers = {}
+
+    def __init__(self, url, entry):
+        self.url = url
+        self.links = {
+            rel: {
+                "url": link_url
+            }
+            for rel, link_url in entry["links"].items()
+        }
+        self.body = entry["body"]
+
+    async def text(self):
+        return self.body
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+def load_etag_cache():
+    try:
+        with open(ETAG_CACHE_PATH) as f:
+            ETAG_CACHE.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+
+def save_etag_cache():
+    cache = {key: ETAG_CACHE[key] for key in ETAG_CACHE_USED}
+    try:
+        os.makedirs(os.path.dirname(ETAG_CACHE_PATH), exist_ok=True)
+        with open(ETAG_CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        log(f'WARNING: Could not save etag cache: {e}', level=1)
+
+
+def get_cache_key(url, params):
+    if not params:
+        return str(url)
+    return f"{url}?{urllib.parse.urlencode(params)}"
+
+
+@retry()
+async def send_req(session, sem, method, url, cache=False, **kwargs):
+    key = get_cache_key(url, kwargs.get("params")) if cache else None
+    cached = ETAG_CACHE.get(key)
+    if cached:
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}), "If-None-Match": cached["etag"]
+        }
+    async with sem:
+        async with session.request(method, url, **kwargs) as response:
+            # read the body so it is still available once the
+            # connection has been released back to the pool
+            await response.read()
+    if cached and response.status == 304:
+        log(f'Not modified {key}', level=1)
+        ETAG_CACHE_USED.add(key)
+        return CachedResponse(response.url, cached)
+    if cache and response.status == 200 and "etag" in response.headers:
+        ETAG_CACHE[key] = {
+            "etag": response.headers["etag"],
+            "body": await response.text(),
+            "links": {
+                rel: str(link["url"])
+                for rel, link in response.links.items()
+            },
+        }
+        ETAG_CACHE_USED.add(key)
+    elif cached:
+        ETAG_CACHE_USED.discard(key)
+    return response
+
+
+async def del_req(session, sem, path):
     log(f'DEL {get_url(path)}', level=0)
-    res = requests.delete(get_url(path), headers=get_base_headers())
-    log(res.status_code, level=1)
-    log(res.text, level=2)
+    res = await send_req(session, sem, "DELETE", get_url(path))
+    text = await res.text()
+    log(res.status, level=1)
+    log(text, level=2)
     if res.ok:
         log(f"Deleted {path}", level=0)
     else:
-        log(res.text, level=0)
-    return res
+        log(text, level=0)
+    return res.ok
+
+
+async def get_page(session, sem, url, params):
+    log(f'GET {url} {params}', level=0)
+    response = await send_req(session,
+                              sem,
+                              "GET",
+                              url,
+                              cache=True,
+                              params=params)
+    text = await response.text()
+    log(response.status, level=1)
+    log(text, level=2)
+    if not response.ok:
+        raise Exception(text)
+    return response, json.loads(text)
+
 
+def get_last_page(response):
+    url = urllib.parse.urlparse(str(response.links["last"]["url"]))
+    return int(urllib.parse.parse_qs(url.query)["page"][0])
 
-def get_req(path, params=None):
-    if params is None:
-        params = {}
-    params.update(page=1)
-    if "per_page" not in params:
-        params["per_page"] = PER_PAGE
+
+async def get_req(session, sem, path, params=None):
+    params = {"per_page": PER_PAGE, **(params or {})}
     url = get_url(path)
-    result = []
-    while True:
-        log(f'GET {url} {params}', level=0)
-        response = requests.get(url, headers=get_base_headers(), params=params)
-        log(response.status_code, level=1)
-        log(response.text, level=2)
-        if not response.ok:
-            raise Exception(response.text)
-        result.extend(response.json())
-
-        if "next" not in response.links:
-            break
+    response, result = await get_page(session, sem, url, params)
+
+    if "last" in response.links:
+        # the total is known, fetch the remaining pages at once
+        last_page = get_last_page(response)
+        pages = await asyncio.gather(
+            *(get_page(session, sem, url, dict(params, page=page))
+              for page in range(2, last_page + 1)))
+        for _, page in pages:
+            result.extend(page)
+        return result
+
+    # the next url already carries the query string
+    while "next" in response.links:
         url = response.links["next"]["url"]
-        if "page" in params:
-            del params["page"]
+        response, page = await get_page(session, sem, url, None)
+        result.extend(page)
     return result
 
 
-def get_list_packages(owner, repo_name, owner_type, package_names):
-    pkgs = []
+async def get_pkg(session, sem, owner, owner_type, package_name):
+    clean_package_name = urllib.parse.quote(package_name, safe='')
+    url = get_url(
+        f"/{owner_type}s/{owner}/packages/container/{clean_package_name}")
+    log(f'GET {url}', level=0)
+    response = await send_req(session, sem, "GET", url, cache=True)
+    text = await response.text()
+    log(response.status, level=1)
+    log(text, level=2)
+    if not response.ok:
+        if response.status == 404:
+            log(f'WARNING: Package {package_name} does not exist.', level=0)
+            return None
+        raise Exception(text)
+    return json.loads(text)
+
+
+async def get_list_packages(session, sem, owner, repo_name, owner_type,
+                            package_names):
     if package_names:
-        for package_name in package_names:
-            clean_package_name = urllib.parse.quote(package_name, safe='')
-            url = get_url(
-                f"/{owner_type}s/{owner}/packages/container/{clean_package_name}"
-            )
-            log(f'GET {url}', level=0)
-            response = requests.get(url, headers=get_base_headers())
-            log(response.status_code, level=1)
-            log(response.text, level=2)
-            if not response.ok:
-                if response.status_code == 404:
-                    log(f'WARNING: Package {package_name} does not exist.', level=0)
-                    continue
-                raise Exception(response.text)
-            pkgs.append(response.json())
+        pkgs = await asyncio.gather(
+            *(get_pkg(session, sem, owner, owner_type, package_name)
+              for package_name in package_names))
+        pkgs = [pkg for pkg in pkgs if pkg is not None]
     else:
-        pkgs = get_req(
+        pkgs = await get_req(
+            session,
+            sem,
             f"/{owner_type}s/{owner}/packages",
             params={'package_type': 'container'},
         )
@@ -103,50 +257,98 @@ def get_list_packages(owner, repo_name, owner_type, package_names):
     return pkgs
 
 
-def get_all_package_versions(owner, repo_name, package_names, owner_type):
-    packages = get_list_packages(
+async def get_all_package_versions(session, sem, owner, repo_name,
+                                   package_names, owner_type):
+    packages = await get_list_packages(
+        session,
+        sem,
         owner=owner,
         repo_name=repo_name,
         package_names=package_names,
         owner_type=owner_type,
     )
+    versions = await asyncio.gather(
+        *(get_all_package_versions_per_pkg(session, sem, pkg["url"])
+          for pkg in packages))
     return {
-        pkg['name']: get_all_package_versions_per_pkg(pkg["url"])
-        for pkg in packages
+        pkg['name']: pkg_versions
+        for pkg, pkg_versions in zip(packages, versions)
     }
 
 
-def get_all_package_versions_per_pkg(package_url):
+async def get_all_package_versions_per_pkg(session, sem, package_url):
     url = f"{package_url}/versions"
-    return get_req(url)
+    return await get_req(session, sem, url)
 
 
-def get_deps_pkgs(owner, pkgs):
-    ids = []
+async def get_deps_pkgs(session, sem, owner, pkgs):
+    # the same digest can be pushed to several packages,
+    # its manifest only needs to be fetched once
+    images = {}
     for pkg in pkgs:
         for pkg_ver in pkgs[pkg]:
-            image = f"{DOCKER_ENDPOINT}{owner}/{pkg}@{pkg_ver['name']}"
-            ids.extend(get_image_deps(image))
+            images.setdefault(pkg_ver['name'], pkg)
+    img_pkgs = set(images.values())
+    tokens = await asyncio.gather(
+        *(get_registry_token(session, sem, owner, pkg) for pkg in img_pkgs))
+    tokens = dict(zip(img_pkgs, tokens))
+    deps = await asyncio.gather(
+        *(get_image_deps(session, sem, owner, pkg, digest, tokens[pkg])
+          for digest, pkg in images.items()))
+    ids = set()
+    for image_deps in deps:
+        ids.update(image_deps)
     return ids
 
 
-def get_image_deps(image):
-    manifest_txt = get_manifest(image)
-    data = json.loads(manifest_txt)
+async def get_image_deps(session, sem, owner, pkg, digest, token):
+    data = await get_manifest(session, sem, owner, pkg, digest, token)
     return [manifest['digest'] for manifest in data.get("manifests", [])]
 
 
-def get_manifest(image):
-    cmd = f"docker manifest inspect {image}"
-    res = subprocess.run(cmd, shell=True, capture_output=True)
-    if res.returncode != 0:
-        log(cmd, level=0)
-        raise Exception(res.stderr)
-    return res.stdout.decode("utf-8")
-
-
-def delete_pkgs(owner, repo_name, owner_type, package_names, untagged_only,
-                except_untagged_multiplatform, older):
+async def get_registry_token(session, sem, owner, pkg):
+    url = f"{REGISTRY_ENDPOINT}/token"
+    params = {
+        "service": "ghcr.io",
+        "scope": f"repository:{owner}/{pkg}:pull",
+    }
+    headers = {"Authorization": aiohttp.BasicAuth(owner, args.token).encode()}
+    log(f'GET {url} {params}', level=0)
+    response = await send_req(session,
+                              sem,
+                              "GET",
+                              url,
+                              params=params,
+                              headers=headers)
+    log(response.status, level=1)
+    if not response.ok:
+        raise Exception(await response.text())
+    return (await response.json())["token"]
+
+
+async def get_manifest(session, sem, owner, pkg, digest, token):
+    url = f"{REGISTRY_ENDPOINT}/v2/{owner}/{pkg}/manifests/{digest}"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": MANIFEST_ACCEPT,
+    }
+    log(f'GET {url}', level=0)
+    response = await send_req(session,
+                              sem,
+                              "GET",
+                              url,
+                              cache=True,
+                              headers=headers)
+    text = await response.text()
+    log(response.status, level=1)
+    log(text, level=2)
+    if not response.ok:
+        raise Exception(text)
+    return json.loads(text)
+
+
+async def delete_pkgs(owner, repo_name, owner_type, package_names,
+                      untagged_only, except_untagged_multiplatform, older):
     log(f'''Delete args:
     owner: {owner}
     repo_name: {repo_name}
@@ -155,63 +357,81 @@ def delete_pkgs(owner, repo_name, owner_type, package_names, untagged_only,
     untagged_only: {untagged_only}
     except_untagged_multiplatform: {except_untagged_multiplatform}
     older: {older}''', level=1)
-    if untagged_only or older > 0:
-        all_packages = get_all_package_versions(
-            owner=owner,
-            repo_name=repo_name,
-            package_names=package_names,
-            owner_type=owner_type,
-        )
-        packages = [
-            pkg_ver for pkg in all_packages for pkg_ver in all_packages[pkg]
-        ]
-        log(f'Total: {len(all_packages)} packages, {len(packages)} versions', level=1)
-
-        if except_untagged_multiplatform:
-            tagged_pkgs = {
-                pkg: [
-                    pkg_ver for pkg_ver in all_packages[pkg]
-                    if pkg_ver["metadata"]["container"]["tags"]
-                ]
-                for pkg in all_packages
-            }
-            deps_pkgs = get_deps_pkgs(owner, tagged_pkgs)
-            log(f'{len(deps_pkgs)} dep packages', level=1)
-
-            packages = [
-                pkg for pkg in packages
-                if pkg["name"] not in deps_pkgs
-            ]
-            log(f'{len(packages)} non-dep versions', level=1)
-
-        if untagged_only:
-            packages = [
-                pkg for pkg in packages
-                if not pkg["metadata"]["container"]["tags"]
-            ]
-            log(f'{len(packages)} untagged versions', level=1)
-
-        if older > 0:
-            # comparing dates as strings works for this format
-            # and is faster than parsing strings to dates before comparing.
-            timestamp = (datetime.now() - timedelta(seconds=older)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # comparing dates as strings works for this format
+    # and is faster than parsing strings to dates before comparing.
+    # the cutoff is taken once, before the listing requests, and versions
+    # are not guaranteed to be sorted by updated_at, so a linear filter
+    # is cheaper than sorting for a bisect.
+    timestamp = (datetime.now(timezone.utc) -
+                 timedelta(seconds=older)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    sem = asyncio.Semaphore(CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit_per_host=CONCURRENCY)
+    headers = {
+        "Authorization": f"Bearer {args.token}",
+        "Accept": "application/vnd.github+json",
+    }
+    async with aiohttp.ClientSession(headers=headers,
+                                     connector=connector) as session:
+        if untagged_only or older > 0:
+            all_packages = await get_all_package_versions(
+                session,
+                sem,
+                owner=owner,
+                repo_name=repo_name,
+                package_names=package_names,
+                owner_type=owner_type,
+            )
             packages = [
-                pkg for pkg in packages
-                if pkg['updated_at'] < timestamp
+                pkg_ver for pkg in all_packages
+                for pkg_ver in all_packages[pkg]
             ]
-            log(f'{len(packages)} older versions', level=1)
-    else:
-        packages = get_list_packages(
-            owner=owner,
-            repo_name=repo_name,
-            package_names=package_names,
-            owner_type=owner_type,
-        )
-        log(f'Total: {len(packages)} packages', level=1)
+            log(f'Total: {len(all_packages)} packages, {len(packages)} versions',
+                level=1)
+
+            filters = []
+            if except_untagged_multiplatform:
+                tagged_pkgs = {
+                    pkg: [
+                        pkg_ver for pkg_ver in all_packages[pkg]
+                        if pkg_ver["metadata"]["container"]["tags"]
+                    ]
+                    for pkg in all_packages
+                }
+                deps_pkgs = await get_deps_pkgs(session, sem, owner,
+                                                tagged_pkgs)
+                log(f'{len(deps_pkgs)} dep packages', level=1)
+                filters.append(
+                    ('non-dep', lambda pkg: pkg["name"] not in deps_pkgs))
+            if untagged_only:
+                filters.append(
+                    ('untagged',
+                     lambda pkg: not pkg["metadata"]["container"]["tags"]))
+            if older > 0:
+                filters.append(
+                    ('older', lambda pkg: pkg['updated_at'] < timestamp))
+
+            for name, keep in filters:
+                packages = [pkg for pkg in packages if keep(pkg)]
+                log(f'{len(packages)} {name} versions', level=1)
+        else:
+            packages = await get_list_packages(
+                session,
+                sem,
+                owner=owner,
+                repo_name=repo_name,
+                package_names=package_names,
+                owner_type=owner_type,
+            )
+            log(f'Total: {len(packages)} packages', level=1)
 
-    status = [del_req(pkg["url"]).ok for pkg in packages]
-    len_ok = len([ok for ok in status if ok])
-    len_fail = len(status) - len_ok
+        len_ok = 0
+        len_fail = 0
+        for deleted in asyncio.as_completed(
+            [del_req(session, sem, pkg["url"]) for pkg in packages]):
+            if await deleted:
+                len_ok += 1
+            else:
+                len_fail += 1
 
     log(f"Deleted {len_ok} package", level=0)
     if "GITHUB_OUTPUT" in os.environ:
@@ -273,7 +493,7 @@ def get_args():
         "--except_untagged_multiplatform",
         type=str2bool,
         help=
-        "Except untagged multiplatform packages from deletion (only for --untagged_only) needs docker installed",
+        "Except untagged multiplatform packages from deletion (only for --untagged_only)",
     )
     parser.add_argument(
         "--older",
@@ -306,12 +526,15 @@ def get_args():
 if __name__ == "__main__":
     args = get_args()
     LOG_LEVEL = args.log_level
-    delete_pkgs(
-        owner=args.repository_owner,
-        repo_name=args.repository,
-        package_names=args.package_names,
-        untagged_only=args.untagged_only,
-        owner_type=args.owner_type,
-        except_untagged_multiplatform=args.except_untagged_multiplatform,
-        older=args.older,
-    )
+    load_etag_cache()
+    atexit.register(save_etag_cache)
+    asyncio.run(
+        delete_pkgs(
+            owner=args.repository_owner,
+            repo_name=args.repository,
+            package_names=args.package_names,
+            untagged_only=args.untagged_only,
+            owner_type=args.owner_type,
+            except_untagged_multiplatform=args.except_untagged_multiplatform,
+            older=args.older,
+        ))